@@ -0,0 +1,26 @@
+"""
+Atomic File Writes
+Output files are written to a temporary file and renamed into place, so readers never see a partial file
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def open_atomic(path, encoding='utf-8'):
+    """Open ``path`` for writing text; the file is replaced only if the block succeeds"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
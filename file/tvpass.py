@@ -1,8 +1,16 @@
 import requests
 import re
 import os
+import sys
+import argparse
 from datetime import datetime, timedelta
 
+# profiling.py and atomicfile.py live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+from atomicfile import open_atomic
+from profiling import span
+
 UPSTREAM_URL = "http://tvpass.org/playlist/m3u"
 LOCAL_FILE = "TVPass.m3u"
 
@@ -129,18 +137,33 @@ def update_playlist(local_pairs, upstream_pairs):
     return updated
 
 def write_playlist(header, updated_pairs):
-    with open(LOCAL_FILE, "w", encoding="utf-8") as f:
+    with open_atomic(LOCAL_FILE) as f:
         f.write(header + "\n")
         for meta, url in updated_pairs:
             f.write(meta + "\n")
             f.write(url + "\n")
     print(f"✅ Updated {LOCAL_FILE} with {len(updated_pairs)} total streams.")
 
+def run():
+    with span('parse'):
+        header, local_pairs = parse_local_playlist()
+    with span('fetch'):
+        upstream_pairs = fetch_upstream_pairs()
+    with span('merge'):
+        updated_pairs = update_playlist(local_pairs, upstream_pairs)
+    with span('write'):
+        write_playlist(header, updated_pairs)
+
 def main():
-    header, local_pairs = parse_local_playlist()
-    upstream_pairs = fetch_upstream_pairs()
-    updated_pairs = update_playlist(local_pairs, upstream_pairs)
-    write_playlist(header, updated_pairs)
+    parser = argparse.ArgumentParser(description=f"Update {LOCAL_FILE} from {UPSTREAM_URL}")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    profiling.start('tvpass', args.profile, args.profile_dir)
+    try:
+        run()
+    finally:
+        profiling.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,108 @@
+"""
+HLS playlist helpers
+Minimal parsing and URI rewriting for master and media playlists
+"""
+
+import re
+from urllib.parse import urljoin
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+# Tags whose URI attribute points at another playlist rather than at media data
+PLAYLIST_URI_TAGS = ('#EXT-X-MEDIA:', '#EXT-X-I-FRAME-STREAM-INF:')
+# Tags whose URI attribute points at keys, init sections and other media data
+SEGMENT_URI_TAGS = ('#EXT-X-KEY:', '#EXT-X-MAP:', '#EXT-X-SESSION-KEY:', '#EXT-X-PRELOAD-HINT:', '#EXT-X-PART:')
+
+
+def parse_attributes(attribute_list):
+    """Parse an HLS attribute list (KEY=VALUE,KEY="VALUE") into a dict"""
+    attributes = {}
+    for key, value in ATTRIBUTE_RE.findall(attribute_list):
+        if value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        attributes[key] = value
+    return attributes
+
+
+def is_master_playlist(text):
+    return '#EXT-X-STREAM-INF' in text
+
+
+def is_endlist(text):
+    return '#EXT-X-ENDLIST' in text
+
+
+def target_duration(text):
+    """Return EXT-X-TARGETDURATION in seconds, or None for master playlists"""
+    match = re.search(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)', text)
+    return float(match.group(1)) if match else None
+
+
+def rewrite_playlist(text, base_url, rewrite):
+    """Rewrite every URI in a playlist.
+
+    ``rewrite(absolute_url, kind)`` is called for each URI, where ``kind`` is
+    ``'playlist'`` for nested playlists and ``'segment'`` for media data, keys
+    and init sections. Its return value replaces the URI.
+    """
+    master = is_master_playlist(text)
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            lines.append(line)
+        elif stripped.startswith('#'):
+            if stripped.startswith(PLAYLIST_URI_TAGS):
+                line = rewrite_uri_attribute(line, base_url, rewrite, 'playlist')
+            elif stripped.startswith(SEGMENT_URI_TAGS):
+                line = rewrite_uri_attribute(line, base_url, rewrite, 'segment')
+            lines.append(line)
+        else:
+            kind = 'playlist' if master else 'segment'
+            lines.append(rewrite(urljoin(base_url, stripped), kind))
+    return '\n'.join(lines) + '\n'
+
+
+def rewrite_uri_attribute(line, base_url, rewrite, kind):
+    def replace(match):
+        return f'URI="{rewrite(urljoin(base_url, match.group(1)), kind)}"'
+
+    return re.sub(r'URI="([^"]*)"', replace, line)
+
+
+def variant_streams(text, base_url):
+    """Return the EXT-X-STREAM-INF variants of a master playlist.
+
+    Each variant is a dict with ``url``, ``bandwidth`` (bits/s, or None) and
+    ``resolution``.
+    """
+    variants = []
+    attributes = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attributes(line.split(':', 1)[1])
+        elif line and not line.startswith('#') and attributes is not None:
+            bandwidth = attributes.get('BANDWIDTH') or attributes.get('AVERAGE-BANDWIDTH')
+            variants.append({
+                'url': urljoin(base_url, line),
+                'bandwidth': int(bandwidth) if bandwidth and bandwidth.isdigit() else None,
+                'resolution': attributes.get('RESOLUTION'),
+            })
+            attributes = None
+    return variants
+
+
+def media_segments(text, base_url):
+    """Return (url, duration) for each segment of a media playlist"""
+    segments = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            match = re.match(r'#EXTINF:\s*(\d+(?:\.\d+)?)', line)
+            duration = float(match.group(1)) if match else None
+        elif line and not line.startswith('#'):
+            segments.append((urljoin(base_url, line), duration))
+            duration = None
+    return segments
@@ -0,0 +1,189 @@
+"""
+Opt-in Run Profiling
+Stage span timing, cProfile and tracemalloc snapshots behind a common --profile option
+"""
+
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+MODES = ('spans', 'cpu', 'mem')
+
+# Shared no-op context manager handed out while profiling is disabled
+_NULL_SPAN = contextlib.nullcontext()
+_active = None
+
+
+class Profiler:
+    """Collects span timings and, optionally, cProfile and tracemalloc data for one run.
+
+    Spans are aggregated per stage name across all threads. cProfile only
+    sees the thread that started the profiler; work done in thread pools
+    shows up there as time spent waiting, and in the span table as the
+    stage's own time.
+    """
+
+    def __init__(self, name, modes=('spans',), output_dir='profile'):
+        self.name = name
+        self.modes = set(modes)
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.cpu = None
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if 'mem' in self.modes:
+            tracemalloc.start()
+        if 'cpu' in self.modes:
+            self.cpu = cProfile.Profile()
+            self.cpu.enable()
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                stats = self.spans.get(stage)
+                if stats is None:
+                    stats = self.spans[stage] = {'count': 0, 'total_s': 0.0, 'max_s': 0.0}
+                stats['count'] += 1
+                stats['total_s'] += elapsed
+                stats['max_s'] = max(stats['max_s'], elapsed)
+
+    def stop(self):
+        """Stop collecting and write the report files; returns the report dict"""
+        wall = time.perf_counter() - self.started
+        os.makedirs(self.output_dir, exist_ok=True)
+        report = {
+            'name': self.name,
+            'finished': datetime.utcnow().isoformat() + 'Z',
+            'modes': sorted(self.modes),
+            'wall_s': round(wall, 3),
+            'spans': {},
+        }
+
+        with self.lock:
+            for stage, stats in sorted(self.spans.items(), key=lambda item: -item[1]['total_s']):
+                report['spans'][stage] = {
+                    'count': stats['count'],
+                    'total_s': round(stats['total_s'], 3),
+                    'mean_ms': round(stats['total_s'] * 1000 / stats['count'], 1),
+                    'max_ms': round(stats['max_s'] * 1000, 1),
+                }
+
+        if self.cpu is not None:
+            self.cpu.disable()
+
+        if 'mem' in self.modes and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, cProfile.__file__),
+            ])
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report['memory'] = {
+                'current_kb': round(current / 1024, 1),
+                'peak_kb': round(peak / 1024, 1),
+                'top_allocations': [
+                    {'where': str(stat.traceback[0]), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:15]
+                ],
+            }
+
+        if self.cpu is not None:
+            pstats_file = os.path.join(self.output_dir, f'{self.name}.pstats')
+            self.cpu.dump_stats(pstats_file)
+            out = io.StringIO()
+            pstats.Stats(self.cpu, stream=out).sort_stats('cumulative').print_stats(25)
+            report['cpu'] = {'pstats_file': pstats_file, 'top_cumulative': out.getvalue()}
+
+        with open(os.path.join(self.output_dir, f'{self.name}-report.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        summary = format_report(report)
+        with open(os.path.join(self.output_dir, f'{self.name}-report.txt'), 'w', encoding='utf-8') as f:
+            f.write(summary)
+        print(summary)
+        return report
+
+
+def format_report(report):
+    lines = [
+        f"Profile report: {report['name']} ({', '.join(report['modes'])})",
+        f"Wall time: {report['wall_s']:.3f}s",
+        '',
+        f"{'stage':<20} {'count':>7} {'total s':>10} {'mean ms':>10} {'max ms':>10}",
+    ]
+    for stage, stats in report['spans'].items():
+        lines.append(f"{stage:<20} {stats['count']:>7} {stats['total_s']:>10.3f} "
+                     f"{stats['mean_ms']:>10.1f} {stats['max_ms']:>10.1f}")
+    if 'memory' in report:
+        memory = report['memory']
+        lines += ['', f"Memory peak: {memory['peak_kb']:.1f} KB (current {memory['current_kb']:.1f} KB)"]
+        for alloc in memory['top_allocations'][:10]:
+            lines.append(f"  {alloc['size_kb']:>10.1f} KB  {alloc['count']:>7}  {alloc['where']}")
+    if 'cpu' in report:
+        lines += ['', f"cProfile stats written to {report['cpu']['pstats_file']}", report['cpu']['top_cumulative']]
+    return '\n'.join(lines) + '\n'
+
+
+def span(stage):
+    """Time a stage of the active run; a shared no-op when profiling is off"""
+    if _active is None:
+        return _NULL_SPAN
+    return _active.span(stage)
+
+
+def parse_modes(value):
+    if not value:
+        return None
+    if value == 'all':
+        return set(MODES)
+    modes = {mode.strip() for mode in value.split(',') if mode.strip()}
+    unknown = modes - set(MODES)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown profile mode(s): {', '.join(sorted(unknown))}")
+    return modes | {'spans'}
+
+
+def add_arguments(parser):
+    """Add the shared --profile and --profile-dir options to an argparse parser"""
+    parser.add_argument(
+        '--profile', nargs='?', const='spans', default=os.environ.get('PROFILE'),
+        type=parse_modes, metavar='MODES',
+        help="profile this run: 'spans' (default), 'cpu', 'mem', a comma list, or 'all'")
+    parser.add_argument(
+        '--profile-dir', default=os.environ.get('PROFILE_DIR', 'profile'),
+        help='directory for profile reports (default: profile)')
+
+
+def start(name, modes, output_dir='profile'):
+    """Start profiling the run if modes is set; returns the Profiler or None"""
+    global _active
+    modes = parse_modes(modes) if isinstance(modes, str) else modes
+    if not modes:
+        return None
+    _active = Profiler(name, modes, output_dir)
+    _active.start()
+    return _active
+
+
+def stop():
+    """Finish the active run, if any, and write its report"""
+    global _active
+    profiler, _active = _active, None
+    if profiler is not None:
+        return profiler.stop()
+    return None
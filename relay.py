@@ -0,0 +1,208 @@
+"""
+Caching HLS Manifest Relay
+Fetches manifests with the scraped Referer/Origin headers and rewrites them to go through the relay
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import quote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import hls
+from scrape_streams import channel_key, origin_headers, variant_rank
+
+logger = logging.getLogger(__name__)
+
+MAX_CACHED_MANIFESTS = 1024
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+class RelayError(Exception):
+    """An upstream or lookup failure, carrying the HTTP status to return"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class HLSRelay:
+    """Serves /stream/<id>.m3u8 for scraped channels and events.
+
+    ``<id>`` is an event id from events.json, or a channel tvg-id from
+    streams.json, which resolves to its best working variant by
+    variant_rank (streams slower than real time only as a last resort). Manifests
+    are cached for half their target duration and concurrent requests for
+    the same manifest share a single upstream fetch.
+    """
+
+    def __init__(self, store, pool_size=16, timeout=15, master_ttl=30, vod_ttl=300):
+        self.store = store
+        self.timeout = timeout
+        self.master_ttl = master_ttl
+        self.vod_ttl = vod_ttl
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'User-Agent': DEFAULT_USER_AGENT,
+            'Accept': '*/*',
+        })
+
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.inflight = {}
+        self.allowed_hosts = {}
+        self._sources = (None, None, {})
+
+    def resolve(self, stream_id):
+        """Return (url, headers) for a stream id, or None if it is unknown"""
+        streams = self.store.get('/streams.json')
+        events = self.store.get('/events.json')
+        if self._sources[0] is not streams or self._sources[1] is not events:
+            self._sources = (streams, events, self.build_sources(streams, events))
+        return self._sources[2].get(stream_id)
+
+    def build_sources(self, streams, events):
+        sources = {}
+
+        if streams is not None:
+            best = {}
+            for channel in streams.data.get('channels', []):
+                if channel.get('status') != 'working':
+                    continue
+                key = channel_key(channel)
+                if key not in best or variant_rank(channel) < variant_rank(best[key]):
+                    best[key] = channel
+            for key, channel in best.items():
+                url = channel.get('stream_url') or channel['original_url']
+                sources[key] = (url, origin_headers(channel['original_url']))
+
+        if events is not None:
+            for event in events.data.get('events', []):
+                if event.get('id') and event.get('m3u8_url'):
+                    sources[event['id']] = (event['m3u8_url'], dict(event.get('headers') or {}))
+
+        return sources
+
+    def manifest(self, stream_id, url=None):
+        """Return the rewritten manifest bytes for a stream id.
+
+        Without ``url`` the stream's source manifest is returned; otherwise
+        ``url`` must be a nested playlist previously handed out by the relay.
+        """
+        source_url, headers = self.lookup(stream_id, url)
+        key = (stream_id, source_url)
+
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.inflight[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            body, ttl = self.fetch_manifest(stream_id, source_url, headers)
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            if len(self.cache) >= MAX_CACHED_MANIFESTS:
+                self.evict()
+            self.cache[key] = (time.monotonic() + ttl, body)
+            self.inflight.pop(key, None)
+        future.set_result(body)
+        return body
+
+    def open_segment(self, stream_id, url):
+        """Open a streaming upstream response for a segment, key or init section"""
+        source_url, headers = self.lookup(stream_id, url)
+        try:
+            response = self.session.get(source_url, headers=headers, timeout=self.timeout,
+                                        stream=True, verify=False)
+        except requests.exceptions.RequestException as e:
+            raise RelayError(502, f'Upstream error: {e}')
+        if response.status_code != 200:
+            response.close()
+            raise RelayError(502, f'Upstream returned {response.status_code}')
+        return response
+
+    def lookup(self, stream_id, url):
+        source = self.resolve(stream_id)
+        if source is None:
+            raise RelayError(404, f'Unknown stream: {stream_id}')
+        source_url, headers = source
+        if url is None:
+            return source_url, headers
+
+        host = urlparse(url).netloc
+        with self.lock:
+            allowed = host in self.allowed_hosts.get(stream_id, ())
+        if not allowed:
+            raise RelayError(403, f'Host not allowed for {stream_id}: {host}')
+        return url, headers
+
+    def fetch_manifest(self, stream_id, url, headers):
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout, verify=False)
+        except requests.exceptions.RequestException as e:
+            raise RelayError(502, f'Upstream error: {e}')
+        if response.status_code != 200:
+            raise RelayError(502, f'Upstream returned {response.status_code}')
+
+        text = response.text
+        if not text.lstrip().startswith('#EXTM3U'):
+            raise RelayError(502, 'Upstream did not return an HLS playlist')
+
+        hosts = {urlparse(url).netloc, urlparse(response.url).netloc}
+
+        def rewrite(absolute_url, kind):
+            hosts.add(urlparse(absolute_url).netloc)
+            name = 'playlist.m3u8' if kind == 'playlist' else 'segment'
+            return f"/stream/{quote(stream_id, safe='')}/{name}?url={quote(absolute_url, safe='')}"
+
+        body = hls.rewrite_playlist(text, response.url, rewrite).encode('utf-8')
+        with self.lock:
+            self.allowed_hosts.setdefault(stream_id, set()).update(hosts)
+
+        return body, self.manifest_ttl(text)
+
+    def manifest_ttl(self, text):
+        if hls.is_master_playlist(text):
+            return self.master_ttl
+        if hls.is_endlist(text):
+            return self.vod_ttl
+        duration = hls.target_duration(text)
+        if duration is None:
+            return 1.0
+        return max(1.0, duration / 2)
+
+    def evict(self):
+        """Make room for one manifest; the caller must hold self.lock
+
+        Expired manifests go first. If the cache is still full, the entries
+        closest to expiry are dropped until it is below MAX_CACHED_MANIFESTS.
+        """
+        now = time.monotonic()
+        for key in [key for key, (expires, _) in self.cache.items() if expires <= now]:
+            del self.cache[key]
+        excess = len(self.cache) - MAX_CACHED_MANIFESTS + 1
+        if excess > 0:
+            by_expiry = sorted(self.cache, key=lambda key: self.cache[key][0])
+            for key in by_expiry[:excess]:
+                del self.cache[key]
@@ -8,13 +8,22 @@ import requests
 import json
 import re
 import time
+import heapq
+import threading
 from datetime import datetime
 from urllib.parse import urlparse
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import argparse
 import urllib3
 
+import hls
+import profiling
+from profiling import span
+from atomicfile import open_atomic
+from store import StreamStore
+
 # Suppress SSL warnings globally
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -22,6 +31,12 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Probe scheduling: a channel that failed its last check counts as this many
+# seconds less stale than a working one, and any channel unchecked for longer
+# than MAX_UNCHECKED_AGE is probed ahead of everything else
+FAILING_PENALTY = 6 * 3600
+MAX_UNCHECKED_AGE = 24 * 3600
+
 class StreamScraper:
     def __init__(self):
         self.session = requests.Session()
@@ -74,17 +89,15 @@ class StreamScraper:
         logger.info(f"Parsed {len(channels)} channels from M3U")
         return channels
     
-    def get_real_stream_url(self, url, max_redirects=5):
-        """Follow redirects to get the actual M3U8 stream URL"""
+    def get_real_stream_url(self, url, max_redirects=5, timings=None):
+        """Follow redirects to get the actual M3U8 stream URL
+
+        If a ``timings`` dict is given, the time to the first byte of the
+        stream response is recorded in it as ``first_byte_ms``.
+        """
         try:
             headers = self.session.headers.copy()
-            parsed_url = urlparse(url)
-            
-            if 'tvpass.org' in parsed_url.netloc or 'thetvapp.to' in parsed_url.netloc:
-                headers.update({
-                    'Referer': f"{parsed_url.scheme}://{parsed_url.netloc}/",
-                    'Origin': f"{parsed_url.scheme}://{parsed_url.netloc}"
-                })
+            headers.update(origin_headers(url))
             
             response = self.session.head(
                 url, 
@@ -105,6 +118,9 @@ class StreamScraper:
                     verify=False
                 )  # ✅ closed properly here
                 
+                if timings is not None:
+                    timings['first_byte_ms'] = round(stream_response.elapsed.total_seconds() * 1000, 1)
+                
                 if stream_response.status_code == 200:
                     content_type = stream_response.headers.get('content-type', '').lower()
                     if 'mpegurl' in content_type or 'm3u8' in content_type:
@@ -132,52 +148,113 @@ class StreamScraper:
             logger.warning(f"Error checking stream {url}: {str(e)}")
             return url, f'error_{str(e)[:50]}'
     
-    def check_channel_batch(self, channels_batch):
-        results = []
-        for channel in channels_batch:
-            logger.info(f"Checking: {channel['name']}")
-            
-            stream_url, status = self.get_real_stream_url(channel['original_url'])
-            
-            channel.update({
-                'stream_url': stream_url,
-                'status': status,
-                'last_checked': datetime.utcnow().isoformat() + 'Z'
-            })
-            
-            results.append(channel)
+    def check_channel(self, channel):
+        logger.info(f"Checking: {channel['name']}")
+        
+        timings = {}
+        started = time.monotonic()
+        with span('probe'):
+            stream_url, status = self.get_real_stream_url(channel['original_url'], timings=timings)
+        
+        channel.update({
+            'stream_url': stream_url,
+            'status': status,
+            'latency_ms': round((time.monotonic() - started) * 1000, 1),
+            'first_byte_ms': timings.get('first_byte_ms'),
+            'last_checked': datetime.utcnow().isoformat() + 'Z'
+        })
+        return channel
+    
+    def check_channel_queue(self, queue, results, lock, deadline=None):
+        """Worker loop: check channels in priority order until the queue is empty or the deadline passes
+
+        Every channel popped from ``queue`` is appended to ``results`` straight
+        away, so a failing check cannot drop channels the worker already did.
+        """
+        checked = 0
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            with lock:
+                if not queue:
+                    break
+                _, channel = heapq.heappop(queue)
+            try:
+                self.check_channel(channel)
+            except Exception as e:
+                logger.error(f"Error checking {channel['name']}: {str(e)}")
+                channel.update({
+                    'status': f'error_{str(e)[:50]}',
+                    'last_checked': datetime.utcnow().isoformat() + 'Z'
+                })
+            with lock:
+                results.append(channel)
+            checked += 1
             time.sleep(0.5)
             
-        return results
+        return checked
     
-    def scrape_streams(self, m3u_url, max_workers=5):
+    def scrape_streams(self, m3u_url, max_workers=5, previous=None, priority_groups=(), deadline=None):
+        """Check every channel in the M3U, highest priority first
+
+        ``previous`` maps channel_id() to the channel's record from the last
+        run; it drives the probe order (see probe_priority) and supplies the
+        results for channels not reached before ``deadline`` seconds elapse.
+        """
         logger.info(f"Starting scrape of {m3u_url}")
+        previous = previous or {}
+        deadline_at = time.monotonic() + deadline if deadline else None
         
         try:
-            response = self.session.get(m3u_url, timeout=30)
-            response.raise_for_status()
-            channels = self.parse_m3u(response.text)
+            with span('fetch'):
+                response = self.session.get(m3u_url, timeout=30)
+                response.raise_for_status()
+            with span('parse'):
+                channels = self.parse_m3u(response.text)
             
             if not channels:
                 logger.error("No channels found in M3U")
                 return []
             
-            batch_size = max(1, len(channels) // max_workers)
-            channel_batches = [channels[i:i + batch_size] for i in range(0, len(channels), batch_size)]
-            logger.info(f"Processing {len(channels)} channels in {len(channel_batches)} batches")
+            now = datetime.utcnow()
+            queue = [
+                (probe_priority(channel, previous.get(channel_id(channel)), priority_groups, now) + (position,), channel)
+                for position, channel in enumerate(channels)
+            ]
+            heapq.heapify(queue)
+            lock = threading.Lock()
+            logger.info(f"Processing {len(channels)} channels with {max_workers} workers"
+                        + (f" (deadline {deadline}s)" if deadline else ""))
             
             all_results = []
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_batch = {executor.submit(self.check_channel_batch, batch): batch for batch in channel_batches}
-                for future in as_completed(future_to_batch):
+                futures = [executor.submit(self.check_channel_queue, queue, all_results, lock, deadline_at)
+                           for _ in range(max_workers)]
+                for future in as_completed(futures):
                     try:
-                        batch_results = future.result()
-                        all_results.extend(batch_results)
-                        logger.info(f"Completed batch: {len(batch_results)} channels")
+                        logger.info(f"Worker finished: {future.result()} channels")
                     except Exception as e:
-                        logger.error(f"Batch processing error: {str(e)}")
+                        logger.error(f"Worker error: {str(e)}")
             
-            all_results.sort(key=lambda x: (x['status'] != 'working', x['group'], x['name']))
+            with span('merge'):
+                # The last deep probe result stays until a new deep probe replaces it,
+                # so variants found slower than real time stay demoted in variant_rank
+                for channel in all_results:
+                    earlier = previous.get(channel_id(channel))
+                    if earlier and 'deep_probe' in earlier:
+                        channel['deep_probe'] = earlier['deep_probe']
+                
+                if queue:
+                    logger.warning(f"Deadline reached: keeping previous results for {len(queue)} unchecked channels")
+                for _, channel in queue:
+                    earlier = previous.get(channel_id(channel))
+                    if earlier:
+                        for key in ('stream_url', 'status', 'latency_ms', 'first_byte_ms', 'last_checked', 'deep_probe'):
+                            if key in earlier:
+                                channel[key] = earlier[key]
+                    all_results.append(channel)
+                
+                all_results.sort(key=lambda x: (x['status'] != 'working', x['group'], x['name']))
             logger.info(f"Scraping completed: {len(all_results)} channels processed")
             working_count = sum(1 for ch in all_results if ch['status'] == 'working')
             logger.info(f"Working streams: {working_count}/{len(all_results)}")
@@ -188,7 +265,177 @@ class StreamScraper:
             logger.error(f"Scraping failed: {str(e)}")
             return []
     
-    def save_to_json(self, channels, output_file='streams.json'):
+    def deep_probe_stream(self, url, headers=None, variant='highest', max_segments=2,
+                          max_segment_bytes=2 * 1024 * 1024):
+        """Fetch a variant's media playlist and a few segments to measure throughput
+
+        Returns a dict with the declared and measured bitrate, per-segment
+        fetch times and a real-time factor: seconds of media downloaded per
+        second of wall time. A factor below 1 means segments arrive slower
+        than they play back. Live playlists are probed at the live edge (the
+        newest segments), VOD playlists from the start. Segment downloads stop
+        after max_segment_bytes; a truncated segment only counts towards the
+        real-time factor when its media time can be estimated.
+        """
+        headers = dict(headers or {})
+        result = {
+            'variant_url': None,
+            'declared_bps': None,
+            'resolution': None,
+            'measured_bps': None,
+            'segment_fetch_ms': None,
+            'realtime_factor': None,
+            'segments': [],
+            'status': 'unknown',
+            'last_checked': datetime.utcnow().isoformat() + 'Z',
+        }
+        try:
+            playlist_url, text, _, _, _ = self.fetch_limited(url, headers, 256 * 1024)
+            if not text.lstrip().startswith(b'#EXTM3U'):
+                result['status'] = 'invalid_playlist'
+                return result
+            text = text.decode('utf-8', errors='replace')
+
+            if hls.is_master_playlist(text):
+                variants = hls.variant_streams(text, playlist_url)
+                if not variants:
+                    result['status'] = 'no_variants'
+                    return result
+                variants.sort(key=lambda v: v['bandwidth'] or 0, reverse=(variant == 'highest'))
+                chosen = variants[0]
+                result['declared_bps'] = chosen['bandwidth']
+                result['resolution'] = chosen['resolution']
+                playlist_url, text, _, _, _ = self.fetch_limited(chosen['url'], headers, 256 * 1024)
+                text = text.decode('utf-8', errors='replace')
+            result['variant_url'] = playlist_url
+
+            segments = hls.media_segments(text, playlist_url)
+            if not segments:
+                result['status'] = 'no_segments'
+                return result
+
+            if hls.is_endlist(text):
+                segments = segments[:max_segments]
+            else:
+                segments = segments[-max_segments:]
+
+            total_bytes = 0
+            total_seconds = 0.0
+            media_seconds = 0.0
+            realtime_seconds = 0.0
+            for segment_url, duration in segments:
+                _, body, elapsed, complete, content_length = self.fetch_limited(
+                    segment_url, headers, max_segment_bytes)
+                total_bytes += len(body)
+                total_seconds += elapsed
+                result['segments'].append({
+                    'duration': duration,
+                    'bytes': len(body),
+                    'fetch_ms': round(elapsed * 1000, 1),
+                    'complete': complete,
+                })
+                if complete and duration:
+                    fetched = duration
+                elif duration and content_length:
+                    fetched = duration * len(body) / content_length
+                elif result['declared_bps']:
+                    fetched = len(body) * 8 / result['declared_bps']
+                else:
+                    # Media time unknown: leave the segment out of the real-time factor
+                    continue
+                media_seconds += fetched
+                realtime_seconds += elapsed
+
+            if total_seconds > 0:
+                result['measured_bps'] = int(total_bytes * 8 / total_seconds)
+                result['segment_fetch_ms'] = round(total_seconds * 1000 / len(result['segments']), 1)
+            if media_seconds and realtime_seconds > 0:
+                result['realtime_factor'] = round(media_seconds / realtime_seconds, 2)
+
+            if result['realtime_factor'] is None:
+                result['status'] = 'unknown'
+            elif result['realtime_factor'] < 1:
+                result['status'] = 'slow'
+            else:
+                result['status'] = 'ok'
+            return result
+
+        except requests.exceptions.Timeout:
+            result['status'] = 'timeout'
+        except requests.exceptions.ConnectionError:
+            result['status'] = 'connection_error'
+        except requests.exceptions.HTTPError as e:
+            result['status'] = f'error_{e.response.status_code}'
+        except Exception as e:
+            logger.warning(f"Error deep probing {url}: {str(e)}")
+            result['status'] = f'error_{str(e)[:50]}'
+        return result
+
+    def fetch_limited(self, url, headers, max_bytes):
+        """GET at most max_bytes of url
+
+        Returns (final_url, body, seconds, complete, content_length), where
+        content_length is the declared body size or None.
+        """
+        started = time.monotonic()
+        with self.session.get(url, headers=headers, timeout=self.timeout,
+                              stream=True, verify=False) as response:
+            response.raise_for_status()
+            content_length = response.headers.get('content-length')
+            content_length = int(content_length) if content_length and content_length.isdigit() else None
+            body = bytearray()
+            complete = True
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                body.extend(chunk)
+                if len(body) >= max_bytes:
+                    complete = False
+                    break
+            return response.url, bytes(body[:max_bytes]), time.monotonic() - started, complete, content_length
+
+    def deep_probe_channels(self, channels, max_workers=3, deadline=None, **options):
+        """Deep probe every working channel with bounded concurrency
+
+        With ``deadline`` (seconds), no new probe starts once it has passed.
+        Only probed channels get a new deep_probe record; channels not reached
+        keep the one carried over from the previous run, if any.
+        """
+        working = [ch for ch in channels if ch['status'] == 'working']
+        logger.info(f"Deep probing {len(working)} working streams with {max_workers} workers"
+                    + (f" (deadline {deadline:.1f}s)" if deadline else ""))
+        deadline_at = time.monotonic() + deadline if deadline else None
+
+        def probe(channel):
+            if deadline_at is not None and time.monotonic() >= deadline_at:
+                return None
+            headers = dict(self.session.headers)
+            headers.update(origin_headers(channel['original_url']))
+            url = channel.get('stream_url') or channel['original_url']
+            with span('probe.deep'):
+                channel['deep_probe'] = self.deep_probe_stream(url, headers, **options)
+            return channel
+
+        probed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in as_completed([executor.submit(probe, ch) for ch in working]):
+                try:
+                    channel = future.result()
+                    if channel is None:
+                        continue
+                    probed += 1
+                    deep = channel['deep_probe']
+                    logger.info(f"Deep probe {channel['name']}: {deep['status']} "
+                                f"(rtf={deep['realtime_factor']}, measured={deep['measured_bps']} bps)")
+                except Exception as e:
+                    logger.error(f"Deep probe error: {str(e)}")
+
+        if probed < len(working):
+            logger.warning(f"Deadline reached: {len(working) - probed} working streams not deep probed, "
+                           "keeping their previous deep probe results")
+        slow = sum(1 for ch in working if is_slow(ch))
+        logger.info(f"Deep probe completed: {probed}/{len(working)} probed, {slow} streams slower than real time")
+        return channels
+
+    def save_to_json(self, channels, output_file='streams.json', db_file=None):
         output_data = {
             'last_updated': datetime.utcnow().isoformat() + 'Z',
             'total_channels': len(channels),
@@ -196,15 +443,157 @@ class StreamScraper:
             'channels': channels
         }
         
-        with open(output_file, 'w', encoding='utf-8') as f:
+        with span('write'), open_atomic(output_file) as f:
             json.dump(output_data, f, indent=2, ensure_ascii=False)
         
         logger.info(f"Saved {len(channels)} channels to {output_file}")
+        
+        if db_file:
+            with span('write.db'), StreamStore(db_file) as store:
+                store.save_channels(channels)
+            logger.info(f"Saved {len(channels)} channels to {db_file}")
 
-def main():
+    def export_m3u(self, channels, output_file='streams.m3u', max_variants=None):
+        """Write an M3U playlist containing only working streams.
+
+        Variants of the same logical channel (same tvg-id, or same name when
+        the entry has none) are listed together in variant_rank order, so
+        variants the deep probe found slower than real time come last.
+        ``max_variants`` keeps only the N best variants of each channel.
+        """
+        groups = {}
+        for channel in channels:
+            if channel.get('status') != 'working':
+                continue
+            groups.setdefault(channel_key(channel), []).append(channel)
+
+        entries = []
+        for variants in groups.values():
+            variants.sort(key=variant_rank)
+            seen_urls = set()
+            kept = []
+            for channel in variants:
+                url = channel.get('stream_url') or channel['original_url']
+                if url in seen_urls:
+                    continue
+                seen_urls.add(url)
+                kept.append((channel, url))
+            if max_variants:
+                kept = kept[:max_variants]
+            entries.append(kept)
+
+        entries.sort(key=lambda kept: (kept[0][0]['group'], kept[0][0]['name']))
+
+        with span('write.m3u'), open_atomic(output_file) as f:
+            f.write('#EXTM3U\n')
+            for kept in entries:
+                for channel, url in kept:
+                    attributes = channel.get('attributes', '')
+                    extinf = f"#EXTINF:{channel.get('duration', -1)}"
+                    if attributes:
+                        extinf += f" {attributes}"
+                    f.write(f"{extinf},{channel['name']}\n")
+                    f.write(f"{url}\n")
+
+        total = sum(len(kept) for kept in entries)
+        logger.info(f"Exported {total} working streams for {len(entries)} channels to {output_file}")
+        return total
+
+    def export_m3u_from_json(self, json_file='streams.json', output_file='streams.m3u', max_variants=None):
+        """Regenerate the M3U export from stored results without re-probing"""
+        with open(json_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return self.export_m3u(data.get('channels', []), output_file, max_variants=max_variants)
+
+def load_previous_results(json_file):
+    """Index the channels of an earlier streams.json by channel_id()"""
+    try:
+        with open(json_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.info(f"No previous results loaded from {json_file}: {e}")
+        return {}
+    return {channel_id(channel): channel for channel in data.get('channels', [])}
+
+def channel_id(channel):
+    """Identity of an M3U entry across runs"""
+    return (channel['name'], channel['original_url'])
+
+def probe_priority(channel, previous, priority_groups=(), now=None):
+    """Heap key ordering probe work; lower values are checked first
+
+    Channels never checked, or unchecked for MAX_UNCHECKED_AGE, are overdue
+    and come first. Then channels in ``priority_groups`` come first, in the
+    listed order. Within a group the score is the time since the last check,
+    less FAILING_PENALTY if that check failed. Working channels are
+    preferred, but a failing channel moves up as it goes stale. It cannot
+    be starved by a --deadline that never reaches its tier.
+    """
+    group = channel.get('group', '')
+    group_rank = priority_groups.index(group) if group in priority_groups else len(priority_groups)
+    
+    if previous is None or not previous.get('last_checked'):
+        return (0, group_rank, float('-inf'))
+    
+    try:
+        checked = datetime.fromisoformat(previous['last_checked'].rstrip('Z'))
+        age = ((now or datetime.utcnow()) - checked).total_seconds()
+    except ValueError:
+        age = float('inf')
+    penalty = 0 if previous.get('status') == 'working' else FAILING_PENALTY
+    overdue = 0 if age >= MAX_UNCHECKED_AGE else 1
+    return (overdue, group_rank, penalty - age)
+
+def origin_headers(url):
+    """Referer/Origin headers the upstream hosts expect for a stream URL"""
+    parsed_url = urlparse(url)
+    if 'tvpass.org' in parsed_url.netloc or 'thetvapp.to' in parsed_url.netloc:
+        return {
+            'Referer': f"{parsed_url.scheme}://{parsed_url.netloc}/",
+            'Origin': f"{parsed_url.scheme}://{parsed_url.netloc}"
+        }
+    return {}
+
+def channel_key(channel):
+    """Key grouping the variants of one logical channel"""
+    match = re.search(r'tvg-id="([^"]+)"', channel.get('attributes', ''))
+    if match:
+        return match.group(1)
+    return channel['name'].lower()
+
+def is_slow(channel):
+    """True if the deep probe found the stream slower than real time"""
+    return (channel.get('deep_probe') or {}).get('status') == 'slow'
+
+def variant_rank(channel):
+    """Sort key ranking variants: slow streams last, then by probe latency and first-byte time"""
+    latency = channel.get('latency_ms')
+    first_byte = channel.get('first_byte_ms')
+    return (
+        is_slow(channel),
+        latency if latency is not None else float('inf'),
+        first_byte if first_byte is not None else float('inf'),
+        channel['name'],
+    )
+
+def run(args):
     M3U_URL = 'https://raw.githubusercontent.com/abusaeeidx/IPTV-Scraper-Zilla/refs/heads/main/TVPass.m3u'
     OUTPUT_FILE = os.environ.get('OUTPUT_FILE', 'streams.json')
+    M3U_FILE = os.environ.get('M3U_FILE', 'streams.m3u')
+    DB_FILE = os.environ.get('DB_FILE')
     MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '3'))
+    MAX_VARIANTS = int(os.environ.get('MAX_VARIANTS', '0')) or None
+    DEEP_PROBE = os.environ.get('DEEP_PROBE') == '1'
+    DEEP_PROBE_WORKERS = int(os.environ.get('DEEP_PROBE_WORKERS', str(MAX_WORKERS)))
+    DEEP_PROBE_SEGMENTS = int(os.environ.get('DEEP_PROBE_SEGMENTS', '2'))
+    PRIORITY_GROUPS = [g.strip() for g in args.priority_groups.split(',') if g.strip()]
+    
+    if os.environ.get('EXPORT_ONLY') == '1':
+        logger.info(f"Regenerating {M3U_FILE} from {OUTPUT_FILE} without probing")
+        StreamScraper().export_m3u_from_json(OUTPUT_FILE, M3U_FILE, max_variants=MAX_VARIANTS)
+        return
+    
+    deadline_at = time.monotonic() + args.deadline if args.deadline else None
     
     logger.info("Starting IPTV stream scraper")
     logger.info(f"M3U URL: {M3U_URL}")
@@ -212,10 +601,21 @@ def main():
     logger.info(f"Max workers: {MAX_WORKERS}")
     
     scraper = StreamScraper()
-    channels = scraper.scrape_streams(M3U_URL, max_workers=MAX_WORKERS)
+    previous = load_previous_results(OUTPUT_FILE)
+    channels = scraper.scrape_streams(M3U_URL, max_workers=MAX_WORKERS, previous=previous,
+                                      priority_groups=PRIORITY_GROUPS, deadline=args.deadline)
+    
+    if channels and DEEP_PROBE:
+        remaining = deadline_at - time.monotonic() if deadline_at is not None else None
+        if remaining is not None and remaining <= 0:
+            logger.warning("Deadline reached: skipping deep probe")
+        else:
+            scraper.deep_probe_channels(channels, max_workers=DEEP_PROBE_WORKERS, deadline=remaining,
+                                        max_segments=DEEP_PROBE_SEGMENTS)
     
     if channels:
-        scraper.save_to_json(channels, OUTPUT_FILE)
+        scraper.save_to_json(channels, OUTPUT_FILE, db_file=DB_FILE)
+        scraper.export_m3u(channels, M3U_FILE, max_variants=MAX_VARIANTS)
         logger.info("Scraping completed successfully")
         total = len(channels)
         working = sum(1 for ch in channels if ch['status'] == 'working')
@@ -227,5 +627,23 @@ def main():
         logger.error("No channels were processed")
         exit(1)
 
+def main():
+    parser = argparse.ArgumentParser(description='Check IPTV streams and save the results')
+    parser.add_argument(
+        '--deadline', type=float, default=float(os.environ.get('DEADLINE', '0')) or None,
+        help='stop starting new probes (including deep probes) after this many seconds; '
+             'unchecked channels keep their previous results')
+    parser.add_argument(
+        '--priority-groups', default=os.environ.get('PRIORITY_GROUPS', ''),
+        help='comma-separated group-title values to check first, most important first')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    
+    profiling.start('scrape_streams', args.profile, args.profile_dir)
+    try:
+        run(args)
+    finally:
+        profiling.stop()
+
 if __name__ == "__main__":
     main()
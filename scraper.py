@@ -7,6 +7,13 @@ from urllib.parse import urljoin, urlparse
 import time
 import sys
 import base64
+import os
+import argparse
+
+import profiling
+from profiling import span
+from atomicfile import open_atomic
+from store import StreamStore
 
 # Try to import selenium, fall back to requests if not available
 try:
@@ -228,9 +235,10 @@ class StreamScraper:
     def fetch_page(self, url):
         """Fetch page content"""
         try:
-            response = requests.get(url, headers=self.headers, timeout=15)
-            response.raise_for_status()
-            return response.text
+            with span('fetch'):
+                response = requests.get(url, headers=self.headers, timeout=15)
+                response.raise_for_status()
+                return response.text
         except Exception as e:
             print(f"Error fetching {url}: {e}")
             return None
@@ -244,7 +252,8 @@ class StreamScraper:
             content = self.fetch_page(iframe_url)
             if content:
                 # Try to decode obfuscated URL
-                m3u8_url = self.decode_obfuscated_url(content)
+                with span('decode'):
+                    m3u8_url = self.decode_obfuscated_url(content)
                 if m3u8_url:
                     print(f"  ✓ Found m3u8 (decoded): {m3u8_url}")
                     return m3u8_url
@@ -267,7 +276,8 @@ class StreamScraper:
             
             # If HTTP didn't work, try Selenium for JavaScript execution
             if SELENIUM_AVAILABLE:
-                return self.extract_m3u8_with_selenium(iframe_url)
+                with span('browser'):
+                    return self.extract_m3u8_with_selenium(iframe_url)
             
             print(f"  ✗ No m3u8 found in iframe")
             return None
@@ -284,7 +294,8 @@ class StreamScraper:
         if SELENIUM_AVAILABLE:
             print("\n=== Attempting direct URL extraction with Selenium ===")
             try:
-                selenium_urls = self.extract_urls_with_selenium(self.events_url)
+                with span('browser'):
+                    selenium_urls = self.extract_urls_with_selenium(self.events_url)
                 print(f"Selenium found {len(selenium_urls)} URLs")
                 for url in selenium_urls[:5]:
                     print(f"  {url[:100]}")
@@ -301,7 +312,8 @@ class StreamScraper:
             f.write(html_content)
         print("Saved page HTML to debug_page.html")
         
-        soup = BeautifulSoup(html_content, 'html.parser')
+        with span('parse'):
+            soup = BeautifulSoup(html_content, 'html.parser')
         events = []
         iframe_urls = []
         event_titles = []
@@ -393,15 +405,15 @@ class StreamScraper:
         
         return events
     
-    def save_to_json(self, events, filename='events.json'):
-        """Save events to JSON file"""
+    def save_to_json(self, events, filename='events.json', db_file=None):
+        """Save events to JSON file, and to a SQLite store if db_file is given"""
         output = {
             'last_updated': datetime.utcnow().isoformat(),
             'total_events': len(events),
             'events': events
         }
         
-        with open(filename, 'w', encoding='utf-8') as f:
+        with span('write'), open_atomic(filename) as f:
             json.dump(output, f, indent=2, ensure_ascii=False)
         
         print(f"\n{'='*50}")
@@ -414,22 +426,40 @@ class StreamScraper:
         print(f"  Events with m3u8 streams: {events_with_streams}")
         print(f"{'='*50}")
         
+        if db_file:
+            with span('write.db'), StreamStore(db_file) as store:
+                store.save_events(events)
+            print(f"✓ Saved {len(events)} events to {db_file}")
+        
         return filename
 
-def main():
+def run():
     print("="*50)
     print("Stream Event Scraper v2.2 - Enhanced Decoder")
     print("="*50)
     
+    db_file = os.environ.get('DB_FILE')
+    
     scraper = StreamScraper()
     events = scraper.extract_events()
     
     if events:
         print(f"\n✓ Successfully extracted {len(events)} events")
-        scraper.save_to_json(events)
+        scraper.save_to_json(events, db_file=db_file)
     else:
         print("\n✗ No events found")
-        scraper.save_to_json([])
+        scraper.save_to_json([], db_file=db_file)
+
+def main():
+    parser = argparse.ArgumentParser(description='Scrape stream events and save them to events.json')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    
+    profiling.start('scraper', args.profile, args.profile_dir)
+    try:
+        run()
+    finally:
+        profiling.stop()
 
 if __name__ == "__main__":
     main()
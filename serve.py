@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Playlist and Stream Metadata Server
+Serves the latest TVPass.m3u, streams.m3u, streams.json and events.json from memory,
+and optionally relays HLS manifests for scraped channels and events (RELAY=1)
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from relay import HLSRelay, RelayError
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# URL path -> (file name, content type, document kind)
+FILES = {
+    '/TVPass.m3u': ('TVPass.m3u', 'audio/x-mpegurl; charset=utf-8', 'm3u'),
+    '/streams.m3u': ('streams.m3u', 'audio/x-mpegurl; charset=utf-8', 'm3u'),
+    '/streams.json': ('streams.json', 'application/json; charset=utf-8', 'streams'),
+    '/events.json': ('events.json', 'application/json; charset=utf-8', 'events'),
+}
+
+# Query parameter -> record field used for filtered views
+FILTERS = {
+    'group': 'group',
+    'status': 'status',
+    'tvg-id': 'tvg_id',
+    'tvg_id': 'tvg_id',
+}
+
+MAX_CACHED_VIEWS = 256
+
+
+class Resource:
+    """An immutable response body with its strong ETag and gzip variant"""
+
+    def __init__(self, body, content_type, last_modified):
+        self.body = body
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.gzip_body = gzip.compress(body, compresslevel=6, mtime=0)
+        self.gzip_etag = self.etag[:-1] + '-gz"'
+
+
+class Document:
+    """A loaded output file with per-field indexes for filtered views"""
+
+    def __init__(self, kind, body, content_type, mtime):
+        self.kind = kind
+        self.content_type = content_type
+        self.mtime = mtime
+        self.resource = Resource(body, content_type, mtime)
+        self.lock = threading.Lock()
+        self.views = {}
+
+        text = body.decode('utf-8')
+        if kind == 'm3u':
+            self.header, self.records = parse_m3u_records(text)
+        else:
+            self.data = json.loads(text)
+            key = 'channels' if kind == 'streams' else 'events'
+            self.records = [record_fields(item) for item in self.data.get(key, [])]
+
+        self.indexes = {field: {} for field in set(FILTERS.values())}
+        for position, record in enumerate(self.records):
+            for field, index in self.indexes.items():
+                value = record['fields'].get(field)
+                if value:
+                    index.setdefault(value.lower(), []).append(position)
+
+    def view(self, filters):
+        """Return the Resource for the given {field: value} filters"""
+        if not filters:
+            return self.resource
+
+        key = tuple(sorted(filters.items()))
+        with self.lock:
+            cached = self.views.get(key)
+        if cached is not None:
+            return cached
+
+        positions = None
+        for field, value in filters.items():
+            matches = set(self.indexes[field].get(value.lower(), ()))
+            positions = matches if positions is None else positions & matches
+        subset = [self.records[p] for p in sorted(positions)]
+
+        resource = Resource(self.render(subset), self.content_type, self.mtime)
+        with self.lock:
+            if len(self.views) >= MAX_CACHED_VIEWS:
+                self.views.clear()
+            self.views[key] = resource
+        return resource
+
+    def render(self, subset):
+        if self.kind == 'm3u':
+            lines = [self.header]
+            for record in subset:
+                lines.extend(record['item'])
+            return ('\n'.join(lines) + '\n').encode('utf-8')
+
+        items = [record['item'] for record in subset]
+        output = dict(self.data)
+        if self.kind == 'streams':
+            output['total_channels'] = len(items)
+            output['working_channels'] = sum(1 for ch in items if ch.get('status') == 'working')
+            output['channels'] = items
+        else:
+            output['total_events'] = len(items)
+            output['events'] = items
+        return json.dumps(output, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def parse_m3u_records(text):
+    """Split an M3U playlist into its header and (EXTINF, URL) records"""
+    lines = text.splitlines()
+    header = lines[0].strip() if lines and lines[0].startswith('#EXTM3U') else '#EXTM3U'
+    records = []
+    meta = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#EXTINF'):
+            meta = line
+        elif line and not line.startswith('#') and meta is not None:
+            group = re.search(r'group-title="([^"]*)"', meta)
+            tvg_id = re.search(r'tvg-id="([^"]*)"', meta)
+            records.append({
+                'item': (meta, line),
+                'fields': {
+                    'group': group.group(1) if group else '',
+                    'tvg_id': tvg_id.group(1) if tvg_id else '',
+                },
+            })
+            meta = None
+    return header, records
+
+
+def record_fields(item):
+    tvg_id = re.search(r'tvg-id="([^"]*)"', item.get('attributes', ''))
+    return {
+        'item': item,
+        'fields': {
+            'group': item.get('group', ''),
+            'status': item.get('status', ''),
+            'tvg_id': tvg_id.group(1) if tvg_id else '',
+        },
+    }
+
+
+class PlaylistStore:
+    """Keeps the latest output files in memory and reloads them when they change"""
+
+    def __init__(self, data_dir='.', reload_interval=2.0):
+        self.data_dir = data_dir
+        self.reload_interval = reload_interval
+        self.documents = {}
+        self.signatures = {}
+        self._stop = threading.Event()
+
+    def get(self, path):
+        return self.documents.get(path)
+
+    def refresh(self):
+        """Reload any output file whose size or mtime changed"""
+        for path, (filename, content_type, kind) in FILES.items():
+            full_path = os.path.join(self.data_dir, filename)
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                if self.documents.pop(path, None) is not None:
+                    logger.info(f"{filename} removed, no longer serving {path}")
+                self.signatures.pop(path, None)
+                continue
+
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if self.signatures.get(path) == signature:
+                continue
+
+            try:
+                with open(full_path, 'rb') as f:
+                    body = f.read()
+                after = os.stat(full_path)
+                if (after.st_mtime_ns, after.st_size) != signature or len(body) != stat.st_size:
+                    # Rewritten while we read it; keep serving the old copy and retry next tick
+                    continue
+                document = Document(kind, body, content_type, stat.st_mtime)
+            except (OSError, ValueError) as e:
+                # The scrapers replace their outputs atomically, so this is a
+                # file written some other way or a genuinely broken one
+                logger.warning(f"Could not load {filename}: {e}")
+                continue
+
+            self.documents[path] = document
+            self.signatures[path] = signature
+            logger.info(f"Loaded {filename} ({len(body)} bytes, {len(document.records)} entries)")
+
+    def watch(self):
+        """Start a background thread that picks up rewritten files"""
+        def loop():
+            while not self._stop.wait(self.reload_interval):
+                self.refresh()
+
+        thread = threading.Thread(target=loop, name='playlist-reloader', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+
+class PlaylistHandler(BaseHTTPRequestHandler):
+    server_version = 'TVPassServe/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        parsed = urlparse(self.path)
+        if parsed.path.startswith('/stream/') and self.server.relay is not None:
+            self.handle_relay(parsed, send_body)
+            return
+
+        document = self.server.store.get(parsed.path)
+        if document is None:
+            self.send_error(404, 'Not Found')
+            return
+
+        filters = {}
+        for name, values in parse_qs(parsed.query).items():
+            if name not in FILTERS:
+                self.send_error(400, f'Unknown filter: {name}')
+                return
+            filters[FILTERS[name]] = values[-1]
+
+        resource = document.view(filters)
+        use_gzip = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        etag = resource.gzip_etag if use_gzip else resource.etag
+        body = resource.gzip_body if use_gzip else resource.body
+
+        if etag_matches(self.headers.get('If-None-Match', ''), etag):
+            self.send_response(304)
+            self.send_common_headers(resource, etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_common_headers(resource, etag)
+        self.send_header('Content-Type', resource.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def handle_relay(self, parsed, send_body):
+        relay = self.server.relay
+        parts = parsed.path[len('/stream/'):].split('/')
+        url = parse_qs(parsed.query).get('url', [None])[-1]
+
+        try:
+            if len(parts) == 1 and parts[0].endswith('.m3u8'):
+                body = relay.manifest(unquote(parts[0][:-len('.m3u8')]))
+            elif len(parts) == 2 and parts[1] == 'playlist.m3u8' and url:
+                body = relay.manifest(unquote(parts[0]), url)
+            elif len(parts) == 2 and parts[1] == 'segment' and url:
+                self.relay_segment(relay.open_segment(unquote(parts[0]), url), send_body)
+                return
+            else:
+                self.send_error(404, 'Not Found')
+                return
+        except RelayError as e:
+            self.send_error(e.status, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def relay_segment(self, response, send_body):
+        with response:
+            self.send_response(200)
+            self.send_header('Content-Type', response.headers.get('Content-Type', 'application/octet-stream'))
+            length = response.headers.get('Content-Length')
+            if length and 'Content-Encoding' not in response.headers:
+                self.send_header('Content-Length', length)
+            else:
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            if send_body:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    self.wfile.write(chunk)
+
+    def send_common_headers(self, resource, etag):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(resource.last_modified, usegmt=True))
+        self.send_header('Cache-Control', f'public, max-age={self.server.max_age}')
+        self.send_header('Vary', 'Accept-Encoding')
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def accepts_gzip(accept_encoding):
+    """True if gzip is acceptable; an explicit gzip entry overrides a * wildcard"""
+    qvalues = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    if 'gzip' in qvalues:
+        return qvalues['gzip'] > 0
+    return qvalues.get('*', 0) > 0
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in candidates or f'W/{etag}' in candidates
+
+
+def make_server(store, host='127.0.0.1', port=8080, max_age=30, relay=None, handler=PlaylistHandler):
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.store = store
+    server.max_age = max_age
+    server.relay = relay
+    return server
+
+
+def main():
+    HOST = os.environ.get('HOST', '127.0.0.1')
+    PORT = int(os.environ.get('PORT', '8080'))
+    DATA_DIR = os.environ.get('DATA_DIR', '.')
+    MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', '30'))
+    RELOAD_INTERVAL = float(os.environ.get('RELOAD_INTERVAL', '2'))
+    RELAY = os.environ.get('RELAY') == '1'
+
+    store = PlaylistStore(DATA_DIR, reload_interval=RELOAD_INTERVAL)
+    store.refresh()
+    store.watch()
+
+    relay = HLSRelay(store) if RELAY else None
+    server = make_server(store, HOST, PORT, max_age=MAX_AGE, relay=relay)
+    logger.info(f"Serving {DATA_DIR} on http://{HOST}:{PORT}/")
+    for path in FILES:
+        logger.info(f"  {path}")
+    if relay is not None:
+        logger.info("  /stream/<id>.m3u8 (HLS relay)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        store.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+SQLite Stream Store
+Indexed storage and probe history for stream and event results
+"""
+
+import json
+import re
+import sqlite3
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    name TEXT NOT NULL,
+    original_url TEXT NOT NULL,
+    tvg_id TEXT,
+    grp TEXT,
+    status TEXT,
+    host TEXT,
+    stream_url TEXT,
+    logo TEXT,
+    duration INTEGER,
+    attributes TEXT,
+    latency_ms REAL,
+    first_byte_ms REAL,
+    last_checked TEXT,
+    PRIMARY KEY (name, original_url)
+);
+CREATE INDEX IF NOT EXISTS idx_channels_tvg_id ON channels (tvg_id);
+CREATE INDEX IF NOT EXISTS idx_channels_grp_status ON channels (grp, status);
+CREATE INDEX IF NOT EXISTS idx_channels_status ON channels (status);
+CREATE INDEX IF NOT EXISTS idx_channels_host ON channels (host);
+
+CREATE TABLE IF NOT EXISTS probe_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    original_url TEXT NOT NULL,
+    tvg_id TEXT,
+    grp TEXT,
+    host TEXT,
+    status TEXT,
+    latency_ms REAL,
+    first_byte_ms REAL,
+    checked_at TEXT NOT NULL,
+    UNIQUE (name, original_url, checked_at)
+);
+CREATE INDEX IF NOT EXISTS idx_history_tvg_id ON probe_history (tvg_id, checked_at);
+CREATE INDEX IF NOT EXISTS idx_history_checked_at ON probe_history (checked_at);
+
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    iframe_url TEXT,
+    m3u8_url TEXT,
+    status TEXT,
+    host TEXT,
+    headers TEXT,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_status ON events (status);
+CREATE INDEX IF NOT EXISTS idx_events_host ON events (host);
+"""
+
+
+class StreamStore:
+    """SQLite backend for streams.json and events.json results.
+
+    ``channels`` and ``events`` hold the latest snapshot; ``probe_history``
+    is append-only with one row per channel check, so repeated saves of the
+    same result do not add duplicate rows.
+    """
+
+    def __init__(self, db_file='streams.db'):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def save_channels(self, channels):
+        """Upsert channel results and append their checks to probe_history"""
+        rows = [channel_row(channel) for channel in channels]
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO channels (name, original_url, tvg_id, grp, status, host, stream_url, logo,
+                                      duration, attributes, latency_ms, first_byte_ms, last_checked)
+                VALUES (:name, :original_url, :tvg_id, :grp, :status, :host, :stream_url, :logo,
+                        :duration, :attributes, :latency_ms, :first_byte_ms, :last_checked)
+                ON CONFLICT (name, original_url) DO UPDATE SET
+                    tvg_id = excluded.tvg_id, grp = excluded.grp, status = excluded.status,
+                    host = excluded.host, stream_url = excluded.stream_url, logo = excluded.logo,
+                    duration = excluded.duration, attributes = excluded.attributes,
+                    latency_ms = excluded.latency_ms, first_byte_ms = excluded.first_byte_ms,
+                    last_checked = excluded.last_checked
+            """, rows)
+            self.conn.executemany("""
+                INSERT OR IGNORE INTO probe_history (name, original_url, tvg_id, grp, host, status,
+                                                     latency_ms, first_byte_ms, checked_at)
+                VALUES (:name, :original_url, :tvg_id, :grp, :host, :status,
+                        :latency_ms, :first_byte_ms, :last_checked)
+            """, [row for row in rows if row['last_checked']])
+        return len(rows)
+
+    def save_events(self, events):
+        """Replace the stored events with the latest scrape"""
+        rows = [{
+            'id': event['id'],
+            'title': event.get('title'),
+            'iframe_url': event.get('iframe_url'),
+            'm3u8_url': event.get('m3u8_url'),
+            'status': event.get('status'),
+            'host': urlparse(event.get('m3u8_url') or event.get('iframe_url') or '').netloc,
+            'headers': json.dumps(event.get('headers') or {}),
+            'timestamp': event.get('timestamp'),
+        } for event in events]
+        with self.conn:
+            self.conn.execute('DELETE FROM events')
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO events (id, title, iframe_url, m3u8_url, status, host, headers, timestamp)
+                VALUES (:id, :title, :iframe_url, :m3u8_url, :status, :host, :headers, :timestamp)
+            """, rows)
+        return len(rows)
+
+    def find_channels(self, tvg_id=None, group=None, status=None, host=None):
+        """Return channels matching all of the given fields"""
+        clauses, params = [], []
+        for column, value in (('tvg_id', tvg_id), ('grp', group), ('status', status), ('host', host)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self.conn.execute(f'SELECT * FROM channels {where} ORDER BY grp, name', params)
+        return [dict(row) for row in rows]
+
+    def working_in_group(self, group):
+        return self.find_channels(group=group, status='working')
+
+    def uptime(self, days=7, tvg_id=None):
+        """Per-channel share of working checks over the last ``days`` days"""
+        since = (datetime.utcnow() - timedelta(days=days)).isoformat() + 'Z'
+        params = [since]
+        extra = ''
+        if tvg_id is not None:
+            extra = 'AND tvg_id = ?'
+            params.append(tvg_id)
+        rows = self.conn.execute(f"""
+            SELECT tvg_id, name, original_url,
+                   COUNT(*) AS checks,
+                   SUM(status = 'working') AS working,
+                   AVG(CASE WHEN status = 'working' THEN latency_ms END) AS avg_latency_ms
+            FROM probe_history
+            WHERE checked_at >= ? {extra}
+            GROUP BY name, original_url
+            ORDER BY tvg_id, name
+        """, params)
+        results = []
+        for row in rows:
+            result = dict(row)
+            result['uptime'] = result['working'] / result['checks'] if result['checks'] else 0.0
+            results.append(result)
+        return results
+
+
+def channel_row(channel):
+    tvg_id = re.search(r'tvg-id="([^"]+)"', channel.get('attributes', ''))
+    return {
+        'name': channel['name'],
+        'original_url': channel['original_url'],
+        'tvg_id': tvg_id.group(1) if tvg_id else None,
+        'grp': channel.get('group'),
+        'status': channel.get('status'),
+        'host': urlparse(channel.get('stream_url') or channel['original_url']).netloc,
+        'stream_url': channel.get('stream_url'),
+        'logo': channel.get('logo'),
+        'duration': channel.get('duration'),
+        'attributes': channel.get('attributes'),
+        'latency_ms': channel.get('latency_ms'),
+        'first_byte_ms': channel.get('first_byte_ms'),
+        'last_checked': channel.get('last_checked'),
+    }